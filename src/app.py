@@ -8,11 +8,18 @@ def parse_arguments():
     parser.add_argument("title", help="The title of the comic to scrape")
     parser.add_argument("--base-url", default="https://komikcast.cz/",
                         help="Base URL of the comic website")
+    parser.add_argument("--start-chapter", type=float, default=None,
+                        help="Chapter number to start scraping from (prompted if omitted)")
     return parser.parse_args()
 
 async def run_scraper():
     args = parse_arguments()
-    await scraper_main(args.title, args.base_url)
+    start_chapter = args.start_chapter
+    if start_chapter is None:
+        # Prompt before the scraper opens any connections, so nothing is waiting on the user
+        user_input = input("Enter starting chapter number (press Enter to scrape all): ").strip()
+        start_chapter = float(user_input) if user_input else None
+    await scraper_main(args.title, args.base_url, start_chapter)
 
 if __name__ == "__main__":
     asyncio.run(run_scraper())
@@ -1,20 +1,23 @@
 from datetime import datetime
 import os
+import io
 import json
-import requests
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin
 import re
 import asyncio
 import aiohttp
+import functools
 import logging
 from aiohttp import ClientSession
 import random
 from typing import List, Dict, Any
 from tqdm import tqdm
 import unicodedata
-from src.services.cloudinary_service import file_exists, folder_exists, upload_image
+from src.services.cloudinary_service import file_exists, get_image_url, list_existing_chapters, prime_cache, upload_image
+from sqlalchemy.dialects.postgresql import insert
 from src.models.comic import Comic
+from src.models.chapter import Chapter
 from src.services.db_connection import SessionLocal
 
 # Constants
@@ -23,36 +26,73 @@ USER_AGENTS: List[str] = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:123.0) Gecko/20100101 Firefox/123.0',
     'Mozilla/5.0 (Macintosh; Intel Mac OS X 14_3_1) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Safari/605.1.15'
 ]
-MAX_CONCURRENT_DOWNLOADS = 3
+# Header sets are built once and shared read-only across requests
+_PAGE_HEADER_POOL: List[Dict[str, str]] = [{'User-Agent': ua} for ua in USER_AGENTS]
+_IMAGE_HEADER_POOL: List[Dict[str, str]] = [
+    {
+        'User-Agent': ua,
+        'Referer': 'https://komikcast.cz/',
+        'Accept': 'image/*',
+        'Accept-Encoding': 'gzip, deflate, br',
+        'Accept-Language': 'en-US,en;q=0.9'
+    } for ua in USER_AGENTS
+]
+MAX_CONCURRENT_CHAPTERS = 16
+CONNECTION_LIMIT = 64
+PER_HOST_LIMIT = 8
+DNS_CACHE_TTL = 300
+MAX_CONCURRENT_IMAGES = 8
 MAX_RETRIES = 3
 RETRY_DELAY = 2
+MAX_RETRY_DELAY = 30
+RETRY_JITTER = 0.5
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+_SANITIZE_RE = re.compile(r'[<>:"/\\|?*]')
+_BAHASA_RE = re.compile(r'\s+Bahasa Indonesia$', re.IGNORECASE)
+_CHAPTER_URL_RE = re.compile(r'chapter-(\d+)')
+_CHAPTER_TEXT_RE = re.compile(r'Chapter (\d+(?:\.\d+)?)')
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@functools.lru_cache(maxsize=1024)
 def sanitize_filename(filename: str) -> str:
     """Sanitize filename to be safe for all operating systems."""
-    filename = re.sub(r'[<>:"/\\|?*]', '', filename)
+    filename = _SANITIZE_RE.sub('', filename)
     filename = unicodedata.normalize('NFKD', filename)
     return filename.strip()
 
-async def fetch_data_with_retry(url: str, max_retries: int = MAX_RETRIES) -> str:
-    """Fetch data with retry mechanism."""
+@functools.lru_cache(maxsize=1024)
+def normalize_title(title: str) -> str:
+    """Sanitize a comic title and drop the site's "Bahasa Indonesia" suffix."""
+    return _BAHASA_RE.sub('', sanitize_filename(title))
+
+def backoff_delay(attempt: int, base: float = RETRY_DELAY) -> float:
+    """Capped exponential backoff with random jitter so concurrent retries don't fire in lockstep."""
+    return min(MAX_RETRY_DELAY, base * (2 ** attempt)) * (1 + random.uniform(0, RETRY_JITTER))
+
+async def fetch_data_with_retry(session: ClientSession, url: str, max_retries: int = MAX_RETRIES) -> str:
+    """Fetch data with retry mechanism, reusing the shared session's connection pool."""
     for attempt in range(max_retries):
         try:
-            headers = {'User-Agent': random.choice(USER_AGENTS)}
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers) as response:
-                    response.raise_for_status()
-                    return await response.text()
+            headers = random.choice(_PAGE_HEADER_POOL)
+            async with session.get(url, headers=headers) as response:
+                response.raise_for_status()
+                return await response.text()
         except Exception as e:
             if attempt == max_retries - 1:
                 logger.error(f"Failed to fetch {url} after {max_retries} attempts: {e}")
                 raise
-            wait_time = RETRY_DELAY * (2 ** attempt)
-            logger.warning(f"Attempt {attempt + 1} failed, retrying in {wait_time}s...")
+            wait_time = backoff_delay(attempt)
+            logger.warning(f"Attempt {attempt + 1} failed, retrying in {wait_time:.1f}s...")
             await asyncio.sleep(wait_time)
 
+async def fetch_soup(session: ClientSession, url: str) -> BeautifulSoup:
+    """Fetch a page and parse it with lxml."""
+    data = await fetch_data_with_retry(session, url)
+    return BeautifulSoup(data, 'lxml')
+
 def safe_select(soup: BeautifulSoup, selector: str, default: str = "N/A") -> str:
     """Safely extract text from BeautifulSoup selector with fallback."""
     try:
@@ -70,16 +110,11 @@ def rate_limited(min_delay=2, max_delay=5):
         return wrapper
     return decorator
 
-# Function to download images with retries
-@rate_limited()
+# Function to download images with retries; throttling comes from the connector's
+# per-host limit and the 429 Retry-After handling, the delay here only staggers bursts
+@rate_limited(min_delay=0, max_delay=0.3)
 async def download_image(session: ClientSession, url: str, comic_slug: str, chapter: str = None, is_cover: bool = False, retries: int = 3):
-    headers = {
-        'User-Agent': random.choice(USER_AGENTS),
-        'Referer': 'https://komikcast.cz/',
-        'Accept': 'image/*',
-        'Accept-Encoding': 'gzip, deflate, br',
-        'Accept-Language': 'en-US,en;q=0.9'
-    }
+    headers = random.choice(_IMAGE_HEADER_POOL)
     for attempt in range(retries):
         try:
             async with session.get(url, headers=headers) as response:
@@ -90,7 +125,10 @@ async def download_image(session: ClientSession, url: str, comic_slug: str, chap
                     continue
 
                 response.raise_for_status()
-                content = await response.read()
+                buffer = io.BytesIO()
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    buffer.write(chunk)
+                buffer.seek(0)
 
                 if is_cover:
                     folder = comic_slug
@@ -101,7 +139,7 @@ async def download_image(session: ClientSession, url: str, comic_slug: str, chap
                 else:
                     raise ValueError("Either 'chapter' or 'is_cover' must be specified")
 
-                result = upload_image(content, folder, filename)
+                result = await upload_image(buffer, folder, filename)
                 if result:
                     return result['secure_url']
                 else:
@@ -111,21 +149,13 @@ async def download_image(session: ClientSession, url: str, comic_slug: str, chap
             if attempt == retries - 1:
                 raise e
             logger.warning(f"Retry {attempt + 1}/{retries} for {url}")
-            await asyncio.sleep(2 ** attempt)
-
-# Function to fetch data
-def fetch_data(url):
-    response = requests.get(url)
-    response.raise_for_status()
-    return response.text
+            await asyncio.sleep(backoff_delay(attempt, base=1))
 
 # Function to save comic metadata
 def save_comic_metadata(comic_meta, comic_slug):
-    db = SessionLocal()
-    try:
-        existing_comic = db.query(Comic).filter(Comic.slug == comic_slug).first()
-        if not existing_comic:
-            new_comic = Comic(
+    with SessionLocal() as db:
+        try:
+            stmt = insert(Comic).values(
                 title=comic_meta['title'],
                 author=comic_meta['author'],
                 type=comic_meta['type'],
@@ -138,36 +168,56 @@ def save_comic_metadata(comic_meta, comic_slug):
                 cover_image_url=comic_meta['cover_image_url'],
                 slug=comic_slug
             )
-            db.add(new_comic)
+            # Single round-trip upsert: insert new comics, only bump updated_on for existing ones
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['slug'],
+                set_={'updated_on': stmt.excluded.updated_on}
+            ).returning(Comic.id)
+            comic_id = db.execute(stmt).scalar()
+            db.commit()
             print(f"Saved comic metadata to database: {comic_slug}")
-        else:
-            existing_comic.updated_on=datetime.now()
-            print(f"Update comic metadata in database: {comic_slug}")
+            return comic_id
+        except Exception as e:
+            db.rollback()
+            print(f"Error saving comic metadata to database: {str(e)}")
+            return None
 
-        db.commit()
-    except Exception as e:
-        db.rollback()
-        print(f"Error saving comic metadata to database: {str(e)}")
-    finally:
-        db.close()
+# Function to save scraped chapters
+def save_chapters(chapter_rows):
+    with SessionLocal() as db:
+        try:
+            # executemany-style insert, skipping the ORM unit of work for each row
+            db.bulk_insert_mappings(Chapter, chapter_rows)
+            db.commit()
+            print(f"Saved {len(chapter_rows)} chapters to database")
+        except Exception as e:
+            db.rollback()
+            print(f"Error saving chapters to database: {str(e)}")
 
 # Function to extract comic metadata
 def extract_comic_meta(soup: BeautifulSoup) -> Dict[str, Any]:
     """Extract comic metadata with error handling."""
     try:
+        # Scope lookups to the info block and read the "Label: value" rows in one pass
+        body = soup.select_one('.komik_info-content-body') or soup
+        info = {}
+        for item in body.select('.komik_info-content-info'):
+            label, sep, value = item.text.strip().partition(':')
+            if sep:
+                info.setdefault(label.strip(), value.strip())
+        rating = next((strong.text.strip() for strong in soup.select('.komik_info-content-rating strong')
+                       if 'Rating' in strong.text), "N/A")
+
         return {
-            'title': re.sub(r'\s+Bahasa Indonesia$', '', sanitize_filename(safe_select(soup, '.komik_info-content-body-title')), flags=re.IGNORECASE),
-            'author': safe_select(soup, '.komik_info-content-info:contains("Author:")')
-                     .replace('Author:', '').strip(),
-            'type': safe_select(soup, '.komik_info-content-info-type a').lower(),
-            'status': safe_select(soup, '.komik_info-content-info:contains("Status:")')
-                     .replace('Status:', '').strip().lower(),
-            'release': safe_select(soup, '.komik_info-content-info-release')
+            'title': normalize_title(safe_select(body, '.komik_info-content-body-title')),
+            'author': info.get('Author', "N/A"),
+            'type': safe_select(body, '.komik_info-content-info-type a').lower(),
+            'status': info.get('Status', "N/A").lower(),
+            'release': safe_select(body, '.komik_info-content-info-release')
                       .replace('Released:', '').strip(),
-            'genres': [g.text.strip() for g in soup.select('.komik_info-content-genre a') or []],
+            'genres': [g.text.strip() for g in body.select('.komik_info-content-genre a') or []],
             'synopsis': safe_select(soup, '.komik_info-description-sinopsis'),
-            'rating': safe_select(soup, '.komik_info-content-rating strong:contains("Rating")')
-                     .replace('Rating ', '').strip(),
+            'rating': rating.replace('Rating ', '').strip(),
         }
     except Exception as e:
         logger.error(f"Failed to extract metadata: {e}")
@@ -177,7 +227,7 @@ def extract_comic_meta(soup: BeautifulSoup) -> Dict[str, Any]:
 async def handle_cover_image(session: ClientSession, cover_image_url: str, comic_slug: str):
     if file_exists(comic_slug, 'cover'):
         print('Cover image already exists. Skipping...')
-        return None
+        return get_image_url(f"{comic_slug}/cover")
     cloudinary_url = await download_image(session, cover_image_url, comic_slug, is_cover=True)
     if cloudinary_url:
         print('Cover image uploaded successfully')
@@ -187,11 +237,8 @@ async def handle_cover_image(session: ClientSession, cover_image_url: str, comic
         return None
 
 # Function to scrape comic metadata and chapters
-async def scrape_comic_meta(session: ClientSession, url, title):
+async def scrape_comic_meta(session: ClientSession, soup: BeautifulSoup, title):
     try:
-        data = fetch_data(url)
-        soup = BeautifulSoup(data, 'html.parser')
-
         comic_meta = extract_comic_meta(soup)
 
         cover_image_url = soup.select_one('.komik_info-content-thumbnail img')['src']
@@ -207,33 +254,40 @@ async def scrape_comic_meta(session: ClientSession, url, title):
         print(f'Failed to scrape comic meta: {str(e)}')
         return None
 
+def get_chapter_number(url: str) -> str:
+    """Extract the chapter number used for the Cloudinary folder name from a chapter URL."""
+    chapter_num_match = _CHAPTER_URL_RE.search(url)
+    return chapter_num_match.group(1) if chapter_num_match else None
+
 # Function to scrape chapter images
-async def scrape_chapter_images(session: ClientSession, url: str, comic_slug: str):
+async def scrape_chapter_images(session: ClientSession, url: str, comic_slug: str,
+                                image_semaphore: asyncio.Semaphore):
     try:
-        chapter_num_match = re.search(r'chapter-(\d+)', url)
-        if not chapter_num_match:
+        chapter_num = get_chapter_number(url)
+        if not chapter_num:
             raise ValueError("Invalid chapter URL")
 
-        chapter_num = chapter_num_match.group(1)
-        chapter_folder = f"{comic_slug}/chapter-{chapter_num}"
-
-        # Check if the chapter folder already exists
-        if folder_exists(chapter_folder):
-            print(f"\nChapter {chapter_num} already exists. Skipping...")
-            return []
-
-        data = fetch_data(url)
-        soup = BeautifulSoup(data, 'html.parser')
+        soup = await fetch_soup(session, url)
 
         images = [img['src'] for img in soup.select('#chapter_body > .main-reading-area img')]
 
-        cloudinary_urls = []
-        for img_url in images:
-            cloudinary_url = await download_image(session, img_url, comic_slug, chapter=chapter_num)
-            if cloudinary_url:
-                cloudinary_urls.append(cloudinary_url)
-
-        return cloudinary_urls
+        async def download_one(img_url):
+            async with image_semaphore:
+                return await download_image(session, img_url, comic_slug, chapter=chapter_num)
+
+        # gather keeps results in page order; collecting exceptions lets every download
+        # finish before returning instead of leaving uploads running in the background
+        results = await asyncio.gather(*(download_one(img_url) for img_url in images),
+                                       return_exceptions=True)
+        failed = False
+        for img_url, result in zip(images, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to download image {img_url} for chapter {chapter_num}: {result}")
+                failed = True
+        # An incomplete chapter must not be recorded as scraped
+        if failed:
+            return []
+        return [cloudinary_url for cloudinary_url in results if cloudinary_url]
 
     except Exception as e:
         print(f'Failed to scrape chapter: {str(e)}')
@@ -245,7 +299,7 @@ async def get_chapter_list(soup):
         chapter_links = soup.select('#chapter-wrapper > li.komik_info-chapters-item > a.chapter-link-item')
         for item in chapter_links:
             chapter_text = item.text.strip().replace("\n", " ")
-            match = re.search(r'Chapter (\d+(\.\d+)?)', chapter_text)
+            match = _CHAPTER_TEXT_RE.search(chapter_text)
             if match:
                 chapters.append({
                     'number': float(match.group(1)),
@@ -257,31 +311,41 @@ async def get_chapter_list(soup):
         print(f"Error extracting chapters: {e}")
         return []
 
-async def download_with_progress(url: str,
-                               session: ClientSession,
-                               semaphore: asyncio.Semaphore,
-                               comic_slug: str,
-                               progress: tqdm):
-    """Download chapter with progress tracking and rate limiting."""
-    try:
-        async with semaphore:
-            await scrape_chapter_images(session, url, comic_slug)
+async def chapter_worker(queue: asyncio.Queue,
+                         session: ClientSession,
+                         comic_slug: str,
+                         progress: tqdm,
+                         scraped: List[Dict[str, Any]],
+                         image_semaphore: asyncio.Semaphore):
+    """Download chapters from the queue until cancelled, collecting their uploaded image URLs."""
+    while True:
+        chapter = await queue.get()
+        try:
+            cloudinary_urls = await scrape_chapter_images(session, chapter['url'], comic_slug, image_semaphore)
+            if cloudinary_urls:
+                scraped.append({'number': chapter['number'], 'urls': cloudinary_urls})
+        except Exception as e:
+            logger.error(f"Failed to download chapter {chapter['url']}: {e}")
+        finally:
             progress.update(1)
-    except Exception as e:
-        logger.error(f"Failed to download chapter {url}: {e}")
+            queue.task_done()
 
 # Main execution function
-async def main(title: str, base_url: str = 'https://komikcast.cz/'):
-    """Enhanced main function with semaphore and progress bars."""
-    semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
-    async with aiohttp.ClientSession() as session:
+async def main(title: str, base_url: str = 'https://komikcast.cz/', start_chapter: float = None):
+    """Enhanced main function with a chapter worker pool and progress bars."""
+    # The connector's per-host cap is what keeps request rates polite towards each host
+    connector = aiohttp.TCPConnector(limit=CONNECTION_LIMIT, limit_per_host=PER_HOST_LIMIT,
+                                     ttl_dns_cache=DNS_CACHE_TTL)
+    async with aiohttp.ClientSession(connector=connector) as session:
         comic_url = urljoin(base_url, f'komik/{title}/')
 
         try:
-            data = await fetch_data_with_retry(comic_url)
-            soup = BeautifulSoup(data, 'html.parser')
+            soup = await fetch_soup(session, comic_url)
+
+            # One paginated listing up front serves every existence check below
+            prime_cache(title)
 
-            comic_meta = await scrape_comic_meta(session, comic_url, title)
+            comic_meta = await scrape_comic_meta(session, soup, title)
             if not comic_meta:
                 logger.error("Failed to get comic metadata")
                 return
@@ -304,36 +368,46 @@ async def main(title: str, base_url: str = 'https://komikcast.cz/'):
             latest_chapter = chapters[-1]['number']
             logger.info(f"Latest chapter: {latest_chapter}")
 
-            user_input = input("Enter starting chapter number (press Enter to scrape all): ").strip()
-            start_chapter = float(user_input) if user_input else None
-
-            save_comic_metadata(comic_meta, title)
-
-            chapters_to_scrape = [ch for ch in chapters
-                                  if not start_chapter or ch['number'] >= start_chapter]
-
+            comic_id = save_comic_metadata(comic_meta, title)
+            if not comic_id:
+                # Uploading chapters without a comic row would leave them unrecorded for good
+                logger.error("Failed to save comic metadata; not scraping chapters")
+                return
 
+            # Served from the primed cache, so filtering is a single in-memory pass
+            existing_chapters = list_existing_chapters(title)
             chapters_to_scrape = [
-                chapter for chapter in chapters_to_scrape
-                if not folder_exists(f"{title}/chapter-{chapter['number']}")
+                chapter for chapter in chapters
+                if (not start_chapter or chapter['number'] >= start_chapter)
+                and get_chapter_number(chapter['url']) not in existing_chapters
             ]
 
             if not chapters_to_scrape:
                 print("All selected chapters already exist. No new chapters to scrape.")
                 return
 
-            # Use semaphore and progress bar
+            queue: asyncio.Queue = asyncio.Queue()
+            for chapter in chapters_to_scrape:
+                queue.put_nowait(chapter)
+
+            # A fixed pool of workers drains the queue, bounding the chapters in flight
+            scraped: List[Dict[str, Any]] = []
+            # Shared by all workers so the total number of in-flight image downloads stays bounded
+            image_semaphore = asyncio.Semaphore(MAX_CONCURRENT_IMAGES)
             with tqdm(total=len(chapters_to_scrape), desc="Downloading chapters") as progress:
-                tasks = [
-                    download_with_progress(
-                        url=chapter['url'],
-                        session=session,
-                        semaphore=semaphore,
-                        comic_slug=title,
-                        progress=progress
-                    ) for chapter in chapters_to_scrape
+                workers = [
+                    asyncio.create_task(chapter_worker(queue, session, title, progress, scraped, image_semaphore))
+                    for _ in range(min(MAX_CONCURRENT_CHAPTERS, len(chapters_to_scrape)))
                 ]
-                await asyncio.gather(*tasks)
+                try:
+                    await queue.join()
+                finally:
+                    for worker in workers:
+                        worker.cancel()
+                    await asyncio.gather(*workers, return_exceptions=True)
+                    # Record whatever was uploaded, even if the run was interrupted
+                    if scraped:
+                        save_chapters([{'comic_id': comic_id, **chapter} for chapter in scraped])
 
         except Exception as e:
             logger.error(f"Failed to process comic: {e}")
@@ -0,0 +1,13 @@
+from sqlalchemy import Column, Integer, Float, JSON, ForeignKey
+from src.models.comic import Base
+
+class Chapter(Base):
+    __tablename__ = 'chapters'
+
+    id = Column(Integer, primary_key=True)
+    comic_id = Column(Integer, ForeignKey('comics.id'), nullable=False)
+    number = Column(Float, nullable=False)
+    urls = Column(JSON, nullable=False)
+
+    def __repr__(self):
+        return f"<Chapter(comic_id='{self.comic_id}', number='{self.number}')>"
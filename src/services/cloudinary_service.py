@@ -1,6 +1,7 @@
 # src/services/cloudinary_service.py
 
 import os
+import asyncio
 from dotenv import load_dotenv
 from cloudinary import config, uploader
 import cloudinary.exceptions
@@ -15,17 +16,22 @@ config(
     api_secret=os.getenv('CLOUDINARY_SECRET_KEY')
 )
 
-def upload_image(image_data, folder, filename):
+async def upload_image(image_data, folder, filename):
     """
     Upload an image to Cloudinary.
 
+    The SDK call is blocking, so it runs in the default thread executor to keep
+    the event loop free for other downloads.
+
     :param image_data: The image data (can be a file-like object, URL, or base64 encoded string)
     :param folder: The folder in Cloudinary where the image should be stored
     :param filename: The filename to use for the image in Cloudinary
     :return: A dictionary containing the upload result, or None if upload failed
     """
     try:
-        result = uploader.upload(image_data, folder=folder, public_id=filename, use_filename=True, unique_filename=False)
+        result = await asyncio.to_thread(uploader.upload, image_data, folder=folder, public_id=filename,
+                                         use_filename=True, unique_filename=False)
+        _cache_public_id(result.get('public_id', ''))
         return result
     except cloudinary.exceptions.Error as e:
         print(f"Error uploading image to Cloudinary: {str(e)}")
@@ -38,14 +44,90 @@ def get_image_url(public_id):
     :param public_id: The public ID of the image in Cloudinary
     :return: The URL of the image
     """
-    return cloudinary.CloudinaryImage(public_id).build_url()
+    return cloudinary.CloudinaryImage(public_id).build_url(secure=True)
 
 # src/services/cloudinary_service.py
 
 from cloudinary import api
 
+# Existing asset paths per comic slug, relative to the comic folder (e.g. "cover",
+# "chapter-12", "chapter-12/001"); filled once per run by prime_cache()
+_existing_cache: dict[str, set[str]] = {}
+
 # ... (keep your existing imports and functions)
 
+def _cache_public_id(public_id):
+    """
+    Record an uploaded public ID and its parent folders in the existence cache.
+
+    :param public_id: The full public ID of the asset, starting with the comic slug
+    """
+    comic_slug, _, relative_path = public_id.partition('/')
+    if comic_slug not in _existing_cache or not relative_path:
+        return
+    parts = relative_path.split('/')
+    for i in range(1, len(parts) + 1):
+        _existing_cache[comic_slug].add('/'.join(parts[:i]))
+
+def _lookup_cache(path):
+    """
+    Look up a path in the existence cache.
+
+    :param path: The full path to check, starting with the comic slug
+    :return: True or False if the comic has been cached, None otherwise
+    """
+    comic_slug, _, relative_path = path.partition('/')
+    if comic_slug not in _existing_cache:
+        return None
+    return relative_path in _existing_cache[comic_slug]
+
+def prime_cache(comic_slug):
+    """
+    Cache every asset already uploaded for a comic.
+
+    Pages through the comic's uploads with one Admin API call per 500 resources,
+    so later existence checks for the comic don't hit the rate-limited Admin API.
+
+    :param comic_slug: The slug (root folder) of the comic
+    :return: True if the cache was filled, False otherwise
+    """
+    public_ids = []
+    next_cursor = None
+    try:
+        while True:
+            params = {'type': "upload", 'prefix': f"{comic_slug}/", 'max_results': 500}
+            if next_cursor:
+                params['next_cursor'] = next_cursor
+            result = api.resources(**params)
+            public_ids.extend(resource['public_id'] for resource in result.get('resources', []))
+            next_cursor = result.get('next_cursor')
+            if not next_cursor:
+                break
+    except Exception as e:
+        print(f"Error listing existing assets: {str(e)}")
+        return False
+
+    _existing_cache[comic_slug] = set()
+    for public_id in public_ids:
+        _cache_public_id(public_id)
+    return True
+
+def _asset_exists(expression, prefix):
+    """
+    Check whether any asset matches a Search API expression.
+
+    :param expression: The Search API expression to match
+    :param prefix: The public ID prefix to list if the account can't use the Search API
+    :return: True if a matching asset exists, False otherwise
+    """
+    try:
+        result = cloudinary.Search().expression(expression).max_results(1).execute()
+        return result.get('total_count', 0) > 0
+    except cloudinary.exceptions.NotAllowed:
+        # Search isn't enabled for every account; fall back to listing by prefix
+        result = api.resources(type="upload", prefix=prefix, max_results=1)
+        return len(result.get('resources', [])) > 0
+
 def folder_exists(folder_path):
     """
     Check if a folder exists in Cloudinary.
@@ -53,12 +135,12 @@ def folder_exists(folder_path):
     :param folder_path: The path of the folder to check
     :return: True if the folder exists, False otherwise
     """
+    cached = _lookup_cache(folder_path)
+    if cached is not None:
+        return cached
     try:
-        # List the contents of the folder
-        result = api.resources(type="upload", prefix=folder_path, max_results=1)
-        # If the folder exists and is not empty, it will have a 'resources' key
-        return 'resources' in result and len(result['resources']) > 0
-    except Exception as e:
+        return _asset_exists(f'folder="{folder_path}"', folder_path)
+    except cloudinary.exceptions.Error as e:
         print(f"Error checking folder existence: {str(e)}")
         return False
 
@@ -70,11 +152,25 @@ def file_exists(folder, filename):
     :param filename: The filename to check
     :return: True if the file exists, False otherwise
     """
+    cached = _lookup_cache(f"{folder}/{filename}")
+    if cached is not None:
+        return cached
     try:
-        # List the contents of the folder
-        result = api.resources(type="upload", prefix=f"{folder}/{filename}", max_results=1)
-        # If the file exists, it will have a 'resources' key
-        return 'resources' in result and len(result['resources']) > 0
-    except Exception as e:
+        return _asset_exists(f'public_id="{folder}/{filename}"', f"{folder}/{filename}")
+    except cloudinary.exceptions.Error as e:
         print(f"Error checking file existence: {str(e)}")
         return False
+
+def list_existing_chapters(comic_slug):
+    """
+    List the chapters of a comic that already have images in Cloudinary.
+
+    :param comic_slug: The slug (root folder) of the comic
+    :return: A set of chapter numbers (as strings) that already exist
+    """
+    if comic_slug not in _existing_cache and not prime_cache(comic_slug):
+        return set()
+    return {
+        path[len('chapter-'):] for path in _existing_cache[comic_slug]
+        if path.startswith('chapter-') and '/' not in path
+    }